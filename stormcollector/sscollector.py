@@ -11,22 +11,33 @@ import aiohttp
 from loguru import logger
 
 from stormcollector import OUTPUT_FOLDER, SSL_CONTEXT
-from stormcollector.aad import query_aad
+from stormcollector.aad import query_aad, save_delta_links
 from stormcollector.arm import query_arm
 from stormcollector.auth import Context
-from stormcollector.utils import json_convert, proactor_win32_patch
+from stormcollector.utils import (
+    json_convert,
+    proactor_win32_patch,
+    sqlite_queue_writer,
+)
 
-if sys.platform == "nix":
-    import uvloop
-
-    uvloop.install()
-elif sys.platform == "win32":
+if sys.platform == "win32":
     sys.unraisablehook = proactor_win32_patch
+else:
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
 
 
 async def run(args: argparse.Namespace):
     context = await args.get_creds(args)
 
+    # Single task owns SQLite output for AAD enumeration
+    context.write_queue = asyncio.Queue(maxsize=1024)
+    writer_task = asyncio.create_task(sqlite_queue_writer(context.write_queue))
+
     tasks = []
     OUTPUT_FOLDER.mkdir(parents=True)
     if args.aad:
@@ -37,7 +48,18 @@ async def run(args: argparse.Namespace):
         tasks.append(query_aad(context, args))
         tasks.append(query_arm(context, args))
 
-    await asyncio.wait(tasks)
+    # Let every task finish so results from successful enumerations are kept
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        logger.opt(exception=error).error(f"Enumeration failed: {error}")
+
+    await context.write_queue.put(None)
+    try:
+        await writer_task
+    except Exception as e:
+        logger.error(f"Writing results failed: {e}")
+        errors.append(e)
     await context.cred_async.close()
 
     if args.json:
@@ -45,6 +67,8 @@ async def run(args: argparse.Namespace):
         await json_convert(OUTPUT_FOLDER)
         logger.info("Finished SQLite to JSON conversion")
 
+    return not errors, context.delta_links
+
 
 def main():
     parentParser = argparse.ArgumentParser(description="Stormcollector", add_help=False)
@@ -73,6 +97,16 @@ def main():
         help="Perform AAD enumeration only for object IDs associated with RBAC enumeration. Only applicable when --azure is specified.",
         action="store_true",
     )
+    parentParser.add_argument(
+        "--pool-size",
+        help="Maximum number of concurrent connections used for AAD enumeration",
+        type=int,
+        default=256,
+    )
+    parentParser.add_argument(
+        "--delta-dir",
+        help="Directory to store AAD delta links. Later runs against the same tenant and cloud using the same directory only collect AAD objects changed since the previous successful run. Only applicable to Microsoft Graph.",
+    )
     parentParser.add_argument(
         "--subs",
         nargs="+",
@@ -121,7 +155,7 @@ def main():
             sslcontext = ssl.create_default_context(cafile=cert_path)
             SSL_CONTEXT = aiohttp.TCPConnector(ssl_context=sslcontext)
 
-        asyncio.run(run(args))
+        succeeded, delta_links = asyncio.run(run(args))
         logger.info(f"--- COMPLETE: {time.time() - start_time} seconds. ---")
         if any(Path(OUTPUT_FOLDER).iterdir()):
             logger.info("Zipping up output...")
@@ -130,7 +164,12 @@ def main():
         else:
             logger.warning("No output to create zip file!")
 
+        # Advance delta links only once this run's output is complete and zipped
+        if succeeded:
+            save_delta_links(delta_links)
         shutil.rmtree(OUTPUT_FOLDER)
+        if not succeeded:
+            sys.exit(1)
 
     else:
         parser.print_help()
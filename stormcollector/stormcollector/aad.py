@@ -1,131 +1,470 @@
 import argparse
 import asyncio
+import base64
 import time
 from dataclasses import dataclass
-from itertools import chain
+from pathlib import Path
+from typing import ClassVar, Optional, Tuple
 
 import aiohttp
+import ijson
+import orjson
+from ijson.common import ObjectBuilder
 from loguru import logger
 
-from . import OUTPUT_FOLDER, SSL_CONTEXT
+from . import OUTPUT_FOLDER
 from .auth import Context
-from .utils import sqlite_writer
+
+# Refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_WINDOW = 300
+TOKEN_RETRY_INTERVAL = 5
+
+# Largest page size Graph allows for directory listings
+PAGE_SIZE = 999
+
+# Objects parsed concurrently per AAD type, bounding in-flight expand requests
+PARSE_CONCURRENCY = 32
+
+# Workers pulling object IDs during backfill enumeration
+BACKFILL_WORKERS = 64
+
+# Graph returns at most 20 items for an expanded navigation property
+EXPAND_LIMIT = 20
+
+# Microsoft Graph accepts at most 20 requests in a single $batch call
+BATCH_SIZE = 20
+BATCH_INTERVAL = 0.05
+
+# Throttled $batch requests are retried after Retry-After, or this many seconds
+BATCH_RETRY_STATUSES = (429, 503, 504)
+BATCH_RETRY_DELAY = 5
+BATCH_MAX_RETRIES = 5
+
+
+def _id(obj: dict) -> str:
+    """Return the ID of a Microsoft Graph (id) or AAD Graph (objectId) object."""
+    return obj.get("id") or obj.get("objectId")
+
+
+def _token_tenant(token: str) -> str:
+    """Return the tenant ID (tid) claim of an access token."""
+    payload = token.split(".")[1]
+    claims = orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    return claims["tid"]
+
+
+async def _iter_page(content: aiohttp.StreamReader, page: dict):
+    """Yield each object in a page's value array as it is parsed.
+
+    Remaining top level keys, such as the next link, are stored in page.
+    """
+    key = builder = item = None
+    async for prefix, event, val in ijson.parse_async(content, use_float=True):
+        if prefix == "":
+            # Top level key boundary. Store the previous key and start the next.
+            if builder is not None:
+                page[key] = builder.value
+            builder = None
+            if event == "map_key":
+                key = val
+                if key != "value":
+                    builder = ObjectBuilder()
+        elif builder is not None:
+            builder.event(event, val)
+        elif prefix.startswith("value.item"):
+            if prefix == "value.item" and event == "start_map":
+                item = ObjectBuilder()
+            item.event(event, val)
+            if prefix == "value.item" and event == "end_map":
+                yield item.value
 
 
 class _TokenEvent(asyncio.Event):
-    """Handles manual refreshing of access tokens during AAD enumeration"""
+    """Handles background refreshing of access tokens during AAD enumeration"""
 
     def __init__(self, ctx: Context, base_url: str, objName: str) -> None:
         super().__init__()
         self.currentToken = None
+        self.headers = None
         self.token_refresh_task = asyncio.create_task(
             self._get_new_token_for_aad_enum(ctx, base_url, objName)
         )
 
+    @staticmethod
+    async def _fetch_token(ctx: Context, scope: str):
+        """Return a new token and the time it should be refreshed."""
+        if hasattr(ctx.cred_async, "get_token_info"):
+            token = await ctx.cred_async.get_token_info(scope)
+            if token.refresh_on:
+                return token, token.refresh_on
+        else:
+            token = await ctx.cred_async.get_token(scope)
+        return token, token.expires_on - TOKEN_REFRESH_WINDOW
+
     async def _get_new_token_for_aad_enum(
         self, ctx: Context, base_url: str, objName: str
     ):
-        """Background task to get new token before access token expiration."""
+        """Background task to swap in a new token while the current one is still valid."""
+        scope = base_url + "/.default"
+        reauth = False
         while True:
-            self.currentToken = await ctx.cred_async.get_token(base_url + "/.default")
+            try:
+                token, refresh_on = await self._fetch_token(ctx, scope)
+            except Exception as e:
+                logger.warning(f"Could not get access token for {objName}: {e}")
+                token = None
 
-            # Set event to resume enumeration
-            self.set()
-
-            # Stop enumeration 15 seconds before token set to expire
             now = int(time.time())
-            await asyncio.sleep(self.currentToken.expires_on - now - 15)
+            if token and token.expires_on > now:
+                if self.currentToken and not self.is_set():
+                    logger.info(f"Resuming {objName} enumeration...")
+
+                # Swap token without blocking in-flight requests
+                self.currentToken = token
+                self.headers = {"Authorization": f"Bearer {token.token}"}
+                self.set()
+                await asyncio.sleep(max(refresh_on - now, TOKEN_RETRY_INTERVAL))
+                continue
+
+            # Keep using the current token until it expires, then pause requests.
+            if self.is_set() and self.currentToken.expires_on <= now:
+                self.clear()
+                logger.info(
+                    f"Waiting for new access tokens for {objName} enumeration..."
+                )
+                reauth = True
+            if reauth:
+                # Paused requests wait on this task, so keep retrying on failure
+                try:
+                    ctx.cred_sync, ctx.cred_async, ctx.cred_msrest = await Context.auth(
+                        ctx.args, ctx
+                    )
+                    reauth = False
+                except Exception as e:
+                    logger.warning(f"Could not re-authenticate for {objName}: {e}")
+            await asyncio.sleep(TOKEN_RETRY_INTERVAL)
 
-            # Prevent requests by clearing event
-            self.clear()
-            logger.info(f"Waiting for new access tokens for {objName} enumeration...")
 
-            # Check to see if expiration has passed yet. Refresh after expiration to be safe.
-            scope = base_url + "/.default"
-            self.currentToken = await ctx.cred_async.get_token(scope)
-            while self.currentToken.expires_on < int(time.time()):
-                await asyncio.sleep(5)
-                self.currentToken = await ctx.cred_async.get_token(scope)
+class _GraphAccess:
+    """Lets the first request of an enumeration run decide whether Graph is accessible"""
 
-            ctx.cred_sync, ctx.cred_async, ctx.cred_msrest = await Context.auth(
-                ctx.args, ctx
-            )
-            logger.info(f"Resuming {objName} enumeration...")
+    def __init__(self) -> None:
+        self.checking = False
+        self.denied = None
+        self.checked = asyncio.Event()
+
+    async def claim(self) -> bool:
+        """Return True if the caller sends the first request, else wait for its outcome."""
+        if not self.checked.is_set():
+            if not self.checking:
+                self.checking = True
+                return True
+            await self.checked.wait()
+        if self.denied is not None:
+            raise PermissionError(self.denied)
+        return False
+
+    def finish(self, denied=None) -> None:
+        self.denied = denied
+        self.checked.set()
+
+
+class _BatchExpander:
+    """Combines expand requests into Microsoft Graph $batch calls"""
+
+    def __init__(self, aad_object: "AADObject") -> None:
+        self.aad_object = aad_object
+        self.queue = asyncio.Queue()
+        self.send_tasks = set()
+        self.batch_task = asyncio.create_task(self._batch_requests())
+
+    async def expand(self, resource_id, prop):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((resource_id, prop, future, 0))
+        return await future
+
+    async def close(self):
+        """Send any queued requests and stop batching."""
+        await self.queue.join()
+        self.batch_task.cancel()
+
+    async def _batch_requests(self):
+        """Background task to flush queued requests every BATCH_SIZE or BATCH_INTERVAL."""
+        while True:
+            pending = [await self.queue.get()]
+            if self.queue.qsize() < BATCH_SIZE - 1:
+                await asyncio.sleep(BATCH_INTERVAL)
+            while len(pending) < BATCH_SIZE and not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+
+            task = asyncio.create_task(self._send(pending))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    @staticmethod
+    def _retry_after(headers) -> int:
+        try:
+            return int(headers.get("Retry-After", BATCH_RETRY_DELAY))
+        except ValueError:
+            return BATCH_RETRY_DELAY
+
+    async def _send(self, pending):
+        obj = self.aad_object
+        batch_url = f"{obj.base_url}/{obj.tenant_id}/$batch"
+        resource = obj.resource
+        requests = [
+            {"id": str(i), "method": "GET", "url": f"/{resource}/{rid}/{prop}"}
+            for i, (rid, prop, _, _) in enumerate(pending)
+        ]
+        retry, delay = [], 0
+
+        try:
+            await obj.token_event.wait()
+            async with obj.session.post(
+                batch_url, json={"requests": requests}, headers=obj.token_event.headers
+            ) as resp:
+                # Throttling responses may not have a JSON body, so don't decode them
+                if resp.status in BATCH_RETRY_STATUSES:
+                    retry, delay = pending, self._retry_after(resp.headers)
+                    response = {}
+                else:
+                    response = orjson.loads(await resp.read())
+                    if "error" in response:
+                        raise Exception(response)
+
+            for item in response.get("responses", ()):
+                request = pending[int(item["id"])]
+                future, status = request[2], item["status"]
+                if future.done():
+                    # Caller was cancelled
+                    continue
+                if status in BATCH_RETRY_STATUSES:
+                    retry.append(request)
+                    delay = max(delay, self._retry_after(item.get("headers") or {}))
+                elif status == 404:
+                    # Object was deleted since it was listed
+                    future.set_result({"value": []})
+                elif status >= 400:
+                    future.set_exception(Exception(item.get("body")))
+                else:
+                    future.set_result(item["body"])
+        except Exception as e:
+            retry = []
+            for _, _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+        if retry:
+            await asyncio.sleep(delay)
+        requeued = set()
+        for rid, prop, future, attempt in retry:
+            if future.done():
+                # Caller was cancelled while waiting to retry
+                continue
+            if attempt < BATCH_MAX_RETRIES:
+                self.queue.put_nowait((rid, prop, future, attempt + 1))
+                requeued.add(future)
+            else:
+                future.set_exception(Exception(f"$batch retries exhausted for {rid}"))
+
+        for _, _, future, _ in pending:
+            if not future.done() and future not in requeued:
+                future.set_exception(Exception("Missing response in $batch result"))
+            self.queue.task_done()
 
 
 @dataclass
 class AADObject:
-    resource = str
+    resource: ClassVar[str]
+    expanded: ClassVar[Optional[str]] = None
+    paged: ClassVar[bool] = True
+    selected: ClassVar[Tuple[str, ...]] = ()
     ctx: Context
     tenant_id: str
     base_url: str
     api_version: str = "api-version=1.6-internal"
+    session: aiohttp.ClientSession = None
+    token_event: _TokenEvent = None
+    access: _GraphAccess = None
 
     def __post_init__(self):
-        self._token_event = _TokenEvent(
-            self.ctx, self.base_url, self.__class__.__name__
-        )
+        # Only Microsoft Graph supports JSON $batch requests and $select
+        self._ms_graph = self.base_url == self.ctx.cloud["GRAPH"]
+        self._batch = _BatchExpander(self) if self._ms_graph else None
+
+        self._resource_url = f"{self.base_url}/{self.tenant_id}/{self.resource}/"
+        self._query = f"?{self.api_version}"
+        self._output = OUTPUT_FOLDER / f"{self.__class__.__name__}.sqlite"
+        self._parse_sem = asyncio.Semaphore(PARSE_CONCURRENCY)
 
     async def parse(self, value):
         return value
 
+    async def close(self):
+        """Flush pending batched expand requests."""
+        if self._batch:
+            await self._batch.close()
+
+    async def _parse_with_sem(self, value):
+        async with self._parse_sem:
+            return await self.parse(value)
+
     async def expand(self, resource_id, prop):
-        user_url = f"{self.base_url}/{self.tenant_id}/{self.resource}/{resource_id}/{prop}?{self.api_version}"
-        headers = {"Authorization": f"Bearer {self._token_event.currentToken.token}"}
-        async with self.session.get(user_url, headers=headers) as expanded:
-            return await expanded.json()
+        """Expand prop for resource_id, batching requests where supported."""
+        if self._batch:
+            return await self._batch.expand(resource_id, prop)
+        return await self._get_expanded(resource_id, prop)
+
+    async def _get_expanded(self, resource_id, prop):
+        user_url = self._resource_url + resource_id + "/" + prop + self._query
+        async with self.session.get(
+            user_url, headers=self.token_event.headers
+        ) as expanded:
+            return await expanded.json(loads=orjson.loads)
+
+    async def expand_ids(self, value, prop):
+        """Return object IDs for prop, querying if $expand was missing or truncated."""
+        expanded = value.get(prop)
+        if (
+            expanded is None
+            or len(expanded) >= EXPAND_LIMIT
+            or f"{prop}@odata.nextLink" in value
+        ):
+            expanded = await self.expand(_id(value), prop)
+            expanded = expanded.get("value") or ()
+        return list(map(_id, expanded))
 
-    @logger.catch()
     async def query_objects(self, object_id: str = None):
 
         # Prevent logging for each backfill item
         if not object_id:
             logger.info(f"Starting query for {self.__class__.__name__}")
 
-        self.session = aiohttp.ClientSession(connector=SSL_CONTEXT)
+        params = [self.api_version]
+        if self._ms_graph and self.selected:
+            params.append(f"$select={','.join(self.selected)}")
+
+        delta_file = None
+        delta_dir = getattr(self.ctx.args, "delta_dir", None)
+
         if object_id:
-            user_url = f"{self.base_url}/{self.tenant_id}/{self.resource}/{object_id}?{self.api_version}"
-        else:
             user_url = (
-                f"{self.base_url}/{self.tenant_id}/{self.resource}?{self.api_version}"
+                self._resource_url + object_id + "?" + "&".join(filter(None, params))
             )
-
-        next_link = True
-        while next_link:
-
-            await self._token_event.wait()
-            headers = {
-                "Authorization": f"Bearer {self._token_event.currentToken.token}"
-            }
-
-            async with self.session.get(user_url, headers=headers) as resp:
-                response = await resp.json()
-                if "odata.error" in response:
-                    raise Exception(response)
-
-                # If response contains value, it's normal enumeration.
-                if response.get("value"):
-                    for value in response["value"]:
-                        parsedVal = await self.parse(value)
-                        await sqlite_writer(
-                            OUTPUT_FOLDER / f"{self.__class__.__name__}.sqlite",
-                            parsedVal,
-                        )
-                    if "odata.nextLink" in response:
-                        user_url = f"{self.base_url}/{self.tenant_id}/{response['odata.nextLink']}&{self.api_version}"
-                    else:
-                        next_link = False
-                # Else it's backfill
+        # Incremental enumeration from the previous run's delta link (Microsoft Graph only)
+        elif delta_dir and self._ms_graph:
+            delta_file = Path(delta_dir) / f"{self.__class__.__name__}.delta"
+            full_url = self._resource_url + "delta?" + "&".join(filter(None, params))
+            user_url = full_url
+
+            await self.token_event.wait()
+            token = self.token_event.currentToken.token
+            delta_scope = {"cloud": self.base_url, "tenant": _token_tenant(token)}
+            if delta_file.exists():
+                try:
+                    saved = orjson.loads(delta_file.read_bytes())
+                except orjson.JSONDecodeError:
+                    saved = {}
+                # A link saved for another tenant or cloud would replay the wrong directory
+                if all(saved.get(key) == val for key, val in delta_scope.items()):
+                    user_url = saved["link"]
                 else:
-                    parsedVal = await self.parse(response)
-                    await sqlite_writer(
-                        OUTPUT_FOLDER / f"{self.__class__.__name__}.sqlite", parsedVal,
+                    logger.warning(
+                        f"Ignoring delta link for {self.__class__.__name__} from another tenant or cloud"
                     )
-                    next_link = False
-
-        # Finish cleanly
-        await self.session.close()
-        self._token_event.token_refresh_task.cancel()
+        else:
+            if self.paged:
+                params.append(f"$top={PAGE_SIZE}")
+            if self.expanded:
+                params.append(f"$expand={self.expanded}")
+            user_url = f"{self.base_url}/{self.tenant_id}/{self.resource}?{'&'.join(filter(None, params))}"
+
+        checking = await self.access.claim() if self.access else False
+        try:
+            next_link = True
+            while next_link:
+
+                await self.token_event.wait()
+                async with self.session.get(
+                    user_url, headers=self.token_event.headers
+                ) as resp:
+                    if resp.status == 410 and delta_file:
+                        logger.warning(
+                            f"Delta link for {self.__class__.__name__} expired. Performing full enumeration."
+                        )
+                        user_url = full_url
+                        continue
+
+                    if resp.status in (401, 403):
+                        error = orjson.loads(await resp.read())
+                        # Only the run's first request means there is no Graph access
+                        if checking:
+                            self.access.finish(denied=error)
+                            checking = False
+                            raise PermissionError(error)
+                        raise Exception(error)
+                    # RBAC assignments can still reference deleted principals
+                    if resp.status == 404 and object_id:
+                        logger.warning(
+                            f"{self.__class__.__name__} {object_id} no longer exists"
+                        )
+                        return
+                    if resp.status >= 400:
+                        raise Exception(orjson.loads(await resp.read()))
+                    if checking:
+                        self.access.finish()
+                        checking = False
+
+                    # Backfill returns a single object
+                    if object_id:
+                        response = orjson.loads(await resp.read())
+                        parsedVal = await self.parse(response)
+                        await self.ctx.write_queue.put((self._output, [parsedVal]))
+                        next_link = False
+                    # Else it's normal enumeration. Parse values as the page streams in.
+                    else:
+                        response = {}
+                        # Start parsing each value as soon as it streams in
+                        parse_tasks = []
+                        try:
+                            async for value in _iter_page(resp.content, response):
+                                if "@removed" not in value:
+                                    parse_tasks.append(
+                                        asyncio.ensure_future(
+                                            self._parse_with_sem(value)
+                                        )
+                                    )
+                            parsedVals = await asyncio.gather(*parse_tasks)
+                        finally:
+                            # Don't leave parses running if the stream or a parse failed
+                            for task in parse_tasks:
+                                task.cancel()
+                        if parsedVals:
+                            await self.ctx.write_queue.put((self._output, parsedVals))
+                        # Microsoft Graph returns an absolute next link, AAD Graph a relative one
+                        if "@odata.nextLink" in response:
+                            user_url = response["@odata.nextLink"]
+                        elif "odata.nextLink" in response:
+                            user_url = f"{self.base_url}/{self.tenant_id}/{response['odata.nextLink']}&{self.api_version}"
+                        else:
+                            next_link = False
+
+                        # Last delta page links to changes made after this run.
+                        # Saved by save_delta_links once the output is finalized.
+                        if delta_file and "@odata.deltaLink" in response:
+                            self.ctx.delta_links[delta_file] = orjson.dumps(
+                                {**delta_scope, "link": response["@odata.deltaLink"]}
+                            )
+
+                        if next_link:
+                            logger.debug(
+                                f"Next page for {self.__class__.__name__}: {user_url}"
+                            )
+
+        finally:
+            # Failed for another reason, so let the other requests decide for themselves
+            if checking:
+                self.access.finish()
 
         # Prevent logging for each backfill item
         if not object_id:
@@ -134,24 +473,43 @@ class AADObject:
 
 @dataclass
 class AADUser(AADObject):
-    resource: str = "users"
+    resource = "users"
+    selected = (
+        "id",
+        "displayName",
+        "userPrincipalName",
+        "mail",
+        "accountEnabled",
+        "userType",
+        "jobTitle",
+        "department",
+        "createdDateTime",
+        "onPremisesSyncEnabled",
+        "onPremisesSecurityIdentifier",
+    )
 
 
 @dataclass
 class AADServicePrincipal(AADObject):
     resource = "servicePrincipals"
+    expanded = "owners"
+    selected = (
+        "id",
+        "appId",
+        "appDisplayName",
+        "displayName",
+        "servicePrincipalType",
+        "servicePrincipalNames",
+        "accountEnabled",
+        "appOwnerOrganizationId",
+        "passwordCredentials",
+        "keyCredentials",
+    )
 
     async def parse(self, value):
 
         if not value.get("microsoftFirstParty"):
-            owners = await self.expand(
-                value.get("objectId") or value.get("id"), "owners"
-            )
-            owner_ids = [
-                owner.get("objectId") or owner.get("id") for owner in owners["value"]
-            ]
-
-            value["owners"] = owner_ids
+            value["owners"] = await self.expand_ids(value, "owners")
         else:
             value["owners"] = []
         return value
@@ -160,181 +518,201 @@ class AADServicePrincipal(AADObject):
 @dataclass
 class AADApplication(AADObject):
     resource = "applications"
+    expanded = "owners"
+    selected = (
+        "id",
+        "appId",
+        "displayName",
+        "signInAudience",
+        "publisherDomain",
+        "createdDateTime",
+        "requiredResourceAccess",
+        "passwordCredentials",
+        "keyCredentials",
+    )
 
     async def parse(self, value):
-        owners = await self.expand(value.get("objectId") or value.get("id"), "owners")
-        owner_ids = [
-            owner.get("objectId") or owner.get("id") for owner in owners["value"]
-        ]
-
-        value["owners"] = owner_ids
+        value["owners"] = await self.expand_ids(value, "owners")
         return value
 
 
 @dataclass
 class AADRole(AADObject):
     resource = "directoryRoles"
+    expanded = "members"
+    paged = False  # directoryRoles does not support $top
+    selected = ("id", "displayName", "description", "roleTemplateId")
 
     async def parse(self, value):
-        members = await self.expand(value.get("objectId"), "members")
-        member_ids = [
-            member.get("objectId") or member.get("id") for member in members["value"]
-        ]
-        value["members"] = member_ids
-
+        value["members"] = await self.expand_ids(value, "members")
         return value
 
 
 @dataclass
 class AADGroup(AADObject):
-    resource: str = "groups"
+    resource = "groups"
+    expanded = "members"
+    selected = (
+        "id",
+        "displayName",
+        "description",
+        "mail",
+        "mailEnabled",
+        "securityEnabled",
+        "groupTypes",
+        "isAssignableToRole",
+        "createdDateTime",
+        "onPremisesSyncEnabled",
+    )
 
     async def parse(self, value):
-        members = await self.expand(value.get("objectId") or value.get("id"), "members")
-        member_ids = [
-            member.get("objectId") or member.get("id") for member in members["value"]
-        ]
+        # Graph only allows one expanded relationship per request, so owners is fetched
+        value["members"] = await self.expand_ids(value, "members")
+        value["owners"] = await self.expand_ids(value, "owners")
+        return value
 
-        owners = await self.expand(value.get("objectId") or value.get("id"), "owners")
-        owner_ids = [
-            owner.get("objectId") or owner.get("id") for owner in owners["value"]
-        ]
 
-        value["members"] = member_ids
-        value["owners"] = owner_ids
-        return value
+async def _backfill_worker(queue: asyncio.Queue, failed: list):
+    while True:
+        aad_object, object_id = await queue.get()
+        try:
+            await aad_object.query_objects(object_id)
+        except PermissionError:
+            # No access to Graph. Drop remaining IDs so queue.join() returns.
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+            raise
+        except Exception as e:
+            # Keep backfilling the remaining IDs
+            logger.error(f"{aad_object.__class__.__name__} {object_id} - {e}")
+            failed.append(object_id)
+        finally:
+            queue.task_done()
 
 
 async def query_aad(ctx: Context, args: argparse.Namespace, backfills: dict = None):
-    logger.info(f"Checking access for Azure AD: {ctx.cloud['AAD']}")
     aad_types = AADObject.__subclasses__()
 
-    token = await ctx.cred_async.get_token(f"{ctx.cloud['AAD']}/.default")
-    headers = {"Authorization": f"Bearer {token.token}"}
-
-    # Test for access to preferred AAD Graph. If fail, fallback to Microsoft Graph.
-    session = aiohttp.ClientSession(headers=headers)
-    user_url = f"{ctx.cloud['AAD']}/me?api-version=1.61-internal"
-    tenantid = args.tenantid if hasattr(args, "tenantid") else "myorganization"
-
-    async with session.get(user_url) as resp:
-        response = await resp.json()
-
-        # If odata.error is in response, it means AAD Graph was unsuccessful.
-        if "odata.error" in response:
-            logger.error(
-                f"{ctx.cloud['AAD']} - {response['odata.error']['code']} - {response['odata.error']['message']['value']}"
-            )
-
-            # Test for access to MS Graph.
-            logger.info(f"Checking access for Microsoft Graph: {ctx.cloud['GRAPH']}")
-            token = await ctx.cred_async.get_token(f"{ctx.cloud['GRAPH']}/.default")
+    # Single session shared by all AAD types so connections are pooled and reused
+    pool_size = getattr(args, "pool_size", 256)
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+    ) as session:
+
+        # Backfill is always performed against Microsoft Graph
+        if backfills:
+            base_url, tenant_id, api_version = ctx.cloud["GRAPH"], "beta", ""
+        else:
+            # Test for access to preferred AAD Graph. If fail, fallback to Microsoft Graph.
+            logger.info(f"Checking access for Azure AD: {ctx.cloud['AAD']}")
+            token = await ctx.cred_async.get_token(f"{ctx.cloud['AAD']}/.default")
             headers = {"Authorization": f"Bearer {token.token}"}
-            user_url = f"{ctx.cloud['GRAPH']}/beta/users"
+            user_url = f"{ctx.cloud['AAD']}/me?api-version=1.61-internal"
+            tenantid = args.tenantid if hasattr(args, "tenantid") else "myorganization"
 
-            async with session.get(user_url, headers=headers) as graph_req:
-                graph_resp = await graph_req.json()
+            async with session.get(user_url, headers=headers) as resp:
+                response = await resp.json(loads=orjson.loads)
 
-                # If "error" in response, no access to MS Graph. Abort AAD enumeration.
-                if "error" in graph_resp:
-                    logger.error(
-                        f"{ctx.cloud['GRAPH']} - {graph_resp['error']['code']} - {graph_resp['error']['message']}"
-                    )
-                    return await session.close()
-
-            if backfills:
-                await asyncio.gather(
-                    list(
-                        chain(
-                            [
-                                AADUser(
-                                    ctx=ctx,
-                                    tenant_id="beta",
-                                    base_url=ctx.cloud["GRAPH"],
-                                    api_version="",
-                                ).query_objects(obj)
-                                for obj in backfills["User"]
-                            ],
-                            [
-                                AADGroup(
-                                    ctx=ctx,
-                                    tenant_id="beta",
-                                    base_url=ctx.cloud["GRAPH"],
-                                    api_version="",
-                                ).query_objects(obj)
-                                for obj in backfills["Group"]
-                            ],
-                            [
-                                AADServicePrincipal(
-                                    ctx=ctx,
-                                    tenant_id="beta",
-                                    base_url=ctx.cloud["GRAPH"],
-                                    api_version="",
-                                ).query_objects(obj)
-                                for obj in backfills["ServicePrincipal"]
-                            ],
-                        )
-                    )
+            # If odata.error is in response, it means AAD Graph was unsuccessful.
+            # Access to MS Graph is checked by the first enumeration request.
+            if "odata.error" in response:
+                logger.error(
+                    f"{ctx.cloud['AAD']} - {response['odata.error']['code']} - {response['odata.error']['message']['value']}"
                 )
-            else:
-                await asyncio.gather(
-                    *[
-                        aad_type(
-                            ctx=ctx,
-                            tenant_id="beta",
-                            base_url=ctx.cloud["GRAPH"],
-                            api_version="",
-                        ).query_objects()
-                        for aad_type in aad_types
-                    ]
+                logger.info(
+                    f"Starting enumeration for Microsoft Graph: {ctx.cloud['GRAPH']}"
                 )
+                base_url, tenant_id, api_version = ctx.cloud["GRAPH"], "beta", ""
+            else:
+                logger.info(f"Starting enumeration for Azure AD: {ctx.cloud['AAD']}")
+                base_url, tenant_id = ctx.cloud["AAD"], tenantid
+                api_version = AADObject.api_version
+
+        # Single token refresher shared by all AAD types
+        token_event = _TokenEvent(ctx, base_url, "AAD")
+        aad_args = dict(
+            ctx=ctx,
+            tenant_id=tenant_id,
+            base_url=base_url,
+            api_version=api_version,
+            session=session,
+            token_event=token_event,
+            access=_GraphAccess(),
+        )
+
+        if backfills:
+            # One instance per type, shared by a bounded pool of workers
+            backfill_objects = {
+                "User": AADUser(**aad_args),
+                "Group": AADGroup(**aad_args),
+                "ServicePrincipal": AADServicePrincipal(**aad_args),
+            }
+            aad_objects = list(backfill_objects.values())
         else:
-            logger.info(f"Starting enumeration for Azure AD: {ctx.cloud['AAD']}")
+            aad_objects = [aad_type(**aad_args) for aad_type in aad_types]
 
+        try:
             if backfills:
-                await asyncio.gather(
-                    *list(
-                        chain(
-                            [
-                                AADUser(
-                                    ctx=ctx,
-                                    tenant_id="beta",
-                                    base_url=ctx.cloud["GRAPH"],
-                                    api_version="",
-                                ).query_objects(obj)
-                                for obj in backfills["User"]
-                            ],
-                            [
-                                AADGroup(
-                                    ctx=ctx,
-                                    tenant_id="beta",
-                                    base_url=ctx.cloud["GRAPH"],
-                                    api_version="",
-                                ).query_objects(obj)
-                                for obj in backfills["Group"]
-                            ],
-                            [
-                                AADServicePrincipal(
-                                    ctx=ctx,
-                                    tenant_id="beta",
-                                    base_url=ctx.cloud["GRAPH"],
-                                    api_version="",
-                                ).query_objects(obj)
-                                for obj in backfills["ServicePrincipal"]
-                            ],
-                        )
-                    )
-                )
+                queue = asyncio.Queue()
+                for key, aad_object in backfill_objects.items():
+                    for object_id in backfills[key]:
+                        queue.put_nowait((aad_object, object_id))
+
+                failed = []
+                workers = [
+                    asyncio.create_task(_backfill_worker(queue, failed))
+                    for _ in range(BACKFILL_WORKERS)
+                ]
+                await queue.join()
+                stopped = [worker for worker in workers if worker.done()]
+                for worker in workers:
+                    worker.cancel()
+                if stopped:
+                    raise stopped[0].exception()
+                if failed:
+                    raise Exception(f"Backfill failed for {len(failed)} objects")
             else:
-                await asyncio.gather(
-                    *[
-                        aad_type(
-                            ctx=ctx, tenant_id=tenantid, base_url=ctx.cloud["AAD"],
-                        ).query_objects()
-                        for aad_type in aad_types
-                    ]
+                # A failed type doesn't stop the others
+                results = await asyncio.gather(
+                    *[aad_object.query_objects() for aad_object in aad_objects],
+                    return_exceptions=True,
                 )
-    await session.close()
+                denied = [e for e in results if isinstance(e, PermissionError)]
+                if denied:
+                    raise denied[0]
+
+                failed = []
+                for aad_object, result in zip(aad_objects, results):
+                    if isinstance(result, Exception):
+                        name = aad_object.__class__.__name__
+                        logger.opt(exception=result).error(f"{name} - {result}")
+                        failed.append(name)
+                if failed:
+                    raise Exception(f"Enumeration failed for {', '.join(failed)}")
+        except PermissionError as e:
+            # No access to the Graph endpoint. Abort AAD enumeration.
+            logger.error(f"{base_url} - {e}")
+        finally:
+            for aad_object in aad_objects:
+                await aad_object.close()
+            token_event.token_refresh_task.cancel()
+
+
+def save_delta_links(delta_links: dict):
+    """Write the delta links collected during enumeration for the next run."""
+    for delta_file, saved in delta_links.items():
+        delta_file.parent.mkdir(parents=True, exist_ok=True)
+        delta_file.write_bytes(saved)
 
 
 async def rbac_backfill(ctx: Context, args: argparse.Namespace, backfills: dict):
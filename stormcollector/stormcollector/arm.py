@@ -129,9 +129,9 @@ async def _query_management_certs(ctx: Context, sub: Subscription):
     return certs
 
 
-@logger.catch()
 async def query_arm(ctx: Context, args: argparse.Namespace) -> None:
     logger.info(f"Starting enumeration for ARM - {ctx.cloud['ARM']}")
+    backfill_errors = []
 
     async with SubscriptionClient(
         ctx.cred_async, base_url=ctx.cloud["ARM"]
@@ -192,7 +192,11 @@ async def query_arm(ctx: Context, args: argparse.Namespace) -> None:
 
             # Only do backfill if azure argument is true (meaning specified on command line)
             if args.azure and args.backfill:
-                await rbac_backfill(ctx, args, backfills)
+                # Finish ARM enumeration before reporting a failed backfill
+                try:
+                    await rbac_backfill(ctx, args, backfills)
+                except Exception as e:
+                    backfill_errors.append(f"{tenant.tenant_id} - {e}")
 
             # ENUMERATE TENANT DATA
             subTasks = [
@@ -204,3 +208,6 @@ async def query_arm(ctx: Context, args: argparse.Namespace) -> None:
 
             tenant_output = OUTPUT_FOLDER / f"tenant.sqlite"
             await sqlite_writer(tenant_output, tenant_dict)
+
+    if backfill_errors:
+        raise Exception(f"AAD backfill failed: {'; '.join(backfill_errors)}")
@@ -50,6 +50,8 @@ class Context:
         self.args = args
         self.cloud = cloud
         self.cred_sync, self.cred_async, self.cred_msrest = authenticatedCreds
+        self.write_queue = None
+        self.delta_links = {}
 
     @staticmethod
     def _get_auth_cloud(cloud: str, config: IO[Any] = None) -> str:
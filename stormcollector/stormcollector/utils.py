@@ -1,5 +1,8 @@
 import asyncio
+import concurrent.futures
+import sqlite3
 import sys
+from collections import defaultdict
 from pathlib import Path
 
 import aiofiles
@@ -19,22 +22,101 @@ def proactor_win32_patch(event):
 
 
 async def sqlite_writer(output: Path, res):
-    if not Path(output).exists():
-        async with aiosqlite.connect(output) as db:
-            await db.execute(
-                """CREATE TABLE IF NOT EXISTS results 
-                (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                result json)"""
-            )
-            await db.commit()
+    await sqlite_batch_writer(output, [res])
+
+
+async def sqlite_batch_writer(output: Path, results):
+    """Insert all results in a single transaction"""
+    if not results:
+        return
 
     async with aiosqlite.connect(output) as db:
-        await db.execute_insert(
-            "INSERT INTO results (result) VALUES (?)", (orjson.dumps(res),)
+        await db.execute(
+            """CREATE TABLE IF NOT EXISTS results 
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            result json)"""
+        )
+        await db.executemany(
+            "INSERT INTO results (result) VALUES (?)",
+            [(orjson.dumps(res),) for res in results],
         )
         await db.commit()
 
 
+def _write_results(connections: dict, batches: dict) -> list:
+    """Write each output's batch, returning the outputs that could not be written."""
+    failed = []
+    for output, results in batches.items():
+        try:
+            db = connections.get(output)
+            if not db:
+                db = connections[output] = sqlite3.connect(output)
+                db.execute(
+                    """CREATE TABLE IF NOT EXISTS results 
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    result json)"""
+                )
+            db.executemany(
+                "INSERT INTO results (result) VALUES (?)",
+                [(orjson.dumps(res),) for res in results],
+            )
+            db.commit()
+        except Exception as e:
+            logger.error(f"Could not write {len(results)} results to {output}: {e}")
+            if output in connections:
+                connections[output].rollback()
+            failed.append(output)
+    return failed
+
+
+def _close_connections(connections: dict):
+    for db in connections.values():
+        db.close()
+
+
+async def sqlite_queue_writer(queue: asyncio.Queue):
+    """Write (output, results) items from queue until a None sentinel is received.
+
+    All SQLite work runs on one dedicated thread so it never blocks the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    connections = {}
+    failed = set()
+
+    finished = False
+    try:
+        while not finished:
+            # Combine everything already queued into one write per output file
+            batches = defaultdict(list)
+            item = await queue.get()
+            while True:
+                if item is None:
+                    finished = True
+                    break
+                output, results = item
+                batches[output].extend(results)
+                if queue.empty():
+                    break
+                item = queue.get_nowait()
+
+            if batches:
+                # Failures are logged and draining continues so producers never block
+                failed.update(
+                    await loop.run_in_executor(
+                        executor, _write_results, connections, batches
+                    )
+                )
+    finally:
+        await loop.run_in_executor(executor, _close_connections, connections)
+        executor.shutdown()
+
+    if failed:
+        raise Exception(
+            f"Results missing from {', '.join(sorted(out.name for out in failed))}"
+        )
+
+
 async def _do_json_convert(file: Path):
     logger.info(f"Converting {file.name}")
     async with aiosqlite.connect(file) as db: